@@ -4,6 +4,9 @@ import subprocess
 import time
 import json
 import logging
+import threading
+import math
+from collections import deque
 # watch for processes
 import wmi
 import pythoncom
@@ -65,18 +68,147 @@ CONTEXT_MENU_ARROW_SELECTED = resource_path('ArrowSelected.png')
 TRAY_TOOLTIP = 'EnforceAudioDevice'
 # registry key
 REG_RUN_PATH = "HKEY_CURRENT_USER\\Software\\Microsoft\\Windows\\CurrentVersion\\Run"
+# timeout for a single wait on a wmi watcher, bounds how long a watcher thread needs to notice it should stop
+WATCHER_TIMEOUT_MSEC = 500
+# startup burst detection: this many launch requests within the window count as a burst
+BURST_WINDOW_SEC = 10.0
+BURST_REQUEST_THRESHOLD = 4
+# during a burst at most this many helper launches run per time slice
+BURST_SLICE_SEC = 1.0
+BURST_LAUNCHES_PER_SLICE = 1
+# during a burst a launch that is overdue by more than this many slices goes before any priority, in
+# deadline order, so low priority apps wait at most about this long plus the overdue launches before them
+BURST_MAX_WAIT_SLICES = 5
+# trace entry kinds
+TRACE_APP = 'a'
+TRACE_PROCESS_CREATED = 'c'
+TRACE_PROCESS_DELETED = 'd'
+TRACE_PROCESS_FOUND = 'f'
+TRACE_RESET = 'x'
+TRACE_SCHEDULED = 's'
+TRACE_RESULT = 'r'
 
 # ------------------------------------------------------------------------------------------
 
-# setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler(LOG_FILE_PATH, "w"),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+
+def setup_logging():
+    """logs to the log file next to the executable and to stdout"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[
+            logging.FileHandler(LOG_FILE_PATH, "w"),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+############################################################################################
+# WmiConnectionPool
+############################################################################################
+
+
+class WmiConnectionPool:
+    """hands out one wmi connection per thread and reuses it until the thread releases it"""
+    # per thread storage of the com initialized wmi connection
+    _local = threading.local()
+    # number of connections currently alive over all threads
+    open_connections = 0
+    _lock = threading.Lock()
+
+    # ------------------------------------------------------------------------------------------
+
+    @classmethod
+    def get(cls):
+        """returns the wmi connection of the calling thread, initializes com and connects on first use"""
+        connection = getattr(cls._local, 'connection', None)
+        if connection is None:
+            pythoncom.CoInitialize()
+            try:
+                connection = wmi.WMI()
+            except Exception:
+                pythoncom.CoUninitialize()
+                raise
+            cls._local.connection = connection
+            with cls._lock:
+                cls.open_connections += 1
+        return connection
+
+    # ------------------------------------------------------------------------------------------
+
+    @classmethod
+    def release(cls):
+        """drops the wmi connection of the calling thread and uninitializes com for it"""
+        if getattr(cls._local, 'connection', None) is None:
+            return
+        # all com references have to be gone before com is uninitialized
+        cls._local.connection = None
+        with cls._lock:
+            cls.open_connections -= 1
+        pythoncom.CoUninitialize()
+
+    # ------------------------------------------------------------------------------------------
+
+    @classmethod
+    def find_processes(cls, name: str):
+        """lists the running processes with the given name, reconnects once if the connection broke"""
+        try:
+            return cls.get().Win32_Process(name=name)
+        except (wmi.x_wmi, pythoncom.com_error) as e:
+            # e.g. the wmi service was restarted, drop the dead connection and try a new one
+            logging.warning(f'WMI query for \'{name}\' failed, reconnecting: {e}')
+            cls.release()
+        try:
+            return cls.get().Win32_Process(name=name)
+        except (wmi.x_wmi, pythoncom.com_error) as e:
+            logging.error(f'WMI query for \'{name}\' failed after reconnecting: {e}')
+            cls.release()
+            return []
+
+############################################################################################
+# TraceRecorder
+############################################################################################
+
+
+class TraceRecorder:
+    """appends timestamped process events, scheduling decisions and helper outcomes to a trace file
+
+    Every recording starts with a header line holding the format version and the wall clock start
+    time, followed by one compact json list per entry: [msec since start, kind, data...]
+    """
+    # version of the trace format, written into every header
+    VERSION = 1
+
+    # ------------------------------------------------------------------------------------------
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'a', encoding='UTF-8')
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+        self.write({'v': self.VERSION, 'start': round(time.time(), 3)})
+
+    # ------------------------------------------------------------------------------------------
+
+    def record(self, kind: str, *data):
+        self.write([int((time.monotonic() - self.start) * 1000), kind, *data])
+
+    # ------------------------------------------------------------------------------------------
+
+    def write(self, entry):
+        with self._lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            # flush every entry so the trace survives a crash of the app
+            self.file.flush()
+
+    # ------------------------------------------------------------------------------------------
+
+    def close(self):
+        with self._lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
 
 ############################################################################################
 # ProcesWatcher
@@ -98,16 +230,25 @@ class ProcessWatcher(QThread):
     def run(self):
         self.continue_run = True
 
-        pythoncom.CoInitialize()
-        c = wmi.WMI()
         if self.Type == "creation" or self.Type == "deletion":
+            watcher = None
+            event = None
             try:
-                watcher = c.Win32_Process.watch_for(self.Type)
+                watcher = WmiConnectionPool.get().Win32_Process.watch_for(self.Type)
                 while self.continue_run:
-                    event = watcher()
+                    # wait with a timeout so the thread is able to end after stop was called
+                    try:
+                        event = watcher(timeout_ms=WATCHER_TIMEOUT_MSEC)
+                    except wmi.x_wmi_timed_out:
+                        continue
                     self.watcher_signal.emit(event.Caption, event.ProcessID)
             except Exception as e:
-                print(e)
+                logging.error(e)
+            finally:
+                # release the watcher and the last event before the connection they belong to
+                event = None
+                watcher = None
+                WmiConnectionPool.release()
         else:
             logging.error(
                 f"Tried to create process listener with invalid type '{self.Type}'. Valid types are: creation, deletion")
@@ -132,14 +273,26 @@ class ProcessWorker(QThread):
     process_dict = {}
     # the parent app containing config data
     app = None
-    # timers that delay the set audio device command (delay is user defined in config)
-    delayedCommandTimers = []
+    # clock the launch deadlines are based on, replaced by a virtual clock when replaying traces
+    clock = staticmethod(time.monotonic)
 
     # ------------------------------------------------------------------------------------------
 
     def __init__(self, parent=None, app=None):
         QObject.__init__(self, parent=parent)
         self.app = app
+        # audio device assignments waiting for their delay to pass or for a free launch slot
+        self.pendingLaunches = []
+        # single timer that wakes the worker when the next pending assignment is due
+        self.launchTimer = QTimer()
+        self.launchTimer.setSingleShot(True)
+        self.launchTimer.setTimerType(Qt.PreciseTimer)
+        self.launchTimer.timeout.connect(self.dispatch_launches)
+        # times of recent launch requests, used to detect startup bursts
+        self.recentRequests = deque()
+        # start and number of launches of the current time slice during a burst
+        self.sliceStart = -math.inf
+        self.sliceLaunches = 0
 
     # ------------------------------------------------------------------------------------------
 
@@ -151,13 +304,19 @@ class ProcessWorker(QThread):
 
     def stop(self):
         # stop all running timers if the application should quit
-        for t in self.delayedCommandTimers:
-            t.stop()
+        self.stop_all_command_timers()
         # stop the loop to quit this thread
         self.loop.quit()
 
     # ------------------------------------------------------------------------------------------
 
+    def record(self, kind: str, *data):
+        """adds an entry to the trace if the app is recording one"""
+        if self.app.trace is not None:
+            self.app.trace.record(kind, *data)
+
+    # ------------------------------------------------------------------------------------------
+
     def add_app(self, application, data):
         """add to or update an app in the process list"""
         if not bool(data):
@@ -185,16 +344,30 @@ class ProcessWorker(QThread):
             except ValueError:
                 logging.warning(f'Delay of \'{application}\' is not a number!')
 
+        # apps with a higher priority get their device first when launches are queued up
+        priority = 0
+        if 'Priority' in data:
+            try:
+                value = float(data['Priority'])
+                priority = int(value)
+                if priority != value:
+                    logging.warning(f'Priority of \'{application}\' is not a whole number, using {priority}!')
+            except (TypeError, ValueError, OverflowError):
+                priority = 0
+                logging.warning(f'Priority of \'{application}\' is not a number!')
+
+        self.record(TRACE_APP, application, device, delay, priority)
         already_contains_app = app_name in self.process_dict
 
         if already_contains_app:
             if self.process_dict[app_name]['AudioDevice'] == device:
-                # nothing changed, just return
+                # device didn't change, just take over the priority
+                self.process_dict[app_name]['Priority'] = priority
                 return
 
         # either the app hasn't been added yet or the device changed
         self.process_dict[app_name] = {'State': False,
-                                       'AudioDevice': device, 'Delay': delay}
+                                       'AudioDevice': device, 'Delay': delay, 'Priority': priority}
 
         logging.info(
             ('Updated' if already_contains_app else 'Added') + ' app: ' + application)
@@ -205,14 +378,26 @@ class ProcessWorker(QThread):
     # -------------------------------------------------------------------------------------------
 
     def check_process(self, process_name):
-        pythoncom.CoInitialize()
-        c = wmi.WMI()
-
-        for process in c.Win32_Process(name=process_name):
+        for process in WmiConnectionPool.find_processes(process_name):
+            self.record(TRACE_PROCESS_FOUND, process_name, process.ProcessID)
             self.process_started(process_name, process.ProcessID)
 
     # ------------------------------------------------------------------------------------------
 
+    def on_process_created(self, name: str, id: int):
+        """handles a process creation event of the watcher"""
+        self.record(TRACE_PROCESS_CREATED, name, id)
+        self.process_started(name, id)
+
+    # ------------------------------------------------------------------------------------------
+
+    def on_process_deleted(self, name: str, id: int):
+        """handles a process deletion event of the watcher"""
+        self.record(TRACE_PROCESS_DELETED, name, id)
+        self.process_ended(name, id)
+
+    # ------------------------------------------------------------------------------------------
+
     def process_started(self, name: str, id: int):
         process_name = name.lower()
         if process_name in self.process_dict:
@@ -245,15 +430,25 @@ class ProcessWorker(QThread):
         if application in self.process_dict:
             audio_device = self.process_dict[application]['AudioDevice']
             command = f'{self.app.sound_volume_view_path} /SetAppDefault "{audio_device}" 0 "{application}"'
-            # queue the command via timer
-            self.set_command_timer(lambda: self.run_command(
-                command, application, audio_device), int(delay * 1000))
+            self.record(TRACE_SCHEDULED, application, audio_device, delay)
+            # queue the command, it is run by dispatch_launches once it is due
+            now = self.clock()
+            self.recentRequests.append(now)
+            self.pendingLaunches.append({'Deadline': now + delay, 'Priority': self.process_dict[application]['Priority'],
+                                         'Application': application, 'AudioDevice': audio_device, 'Command': command,
+                                         'Burst': False})
+            if self.in_startup_burst(now):
+                # everything queued so far belongs to the burst and stays throttled until it is launched
+                for launch in self.pendingLaunches:
+                    launch['Burst'] = True
+            self.schedule_next_launch(now)
 
     # ------------------------------------------------------------------------------------------
 
     def run_command(self, command, application_name, audio_device):
         #res = os.system(command)
         res = subprocess.call(command, shell=False)
+        self.record(TRACE_RESULT, application_name, audio_device, res)
         if res == 0:
             logging.info(
                 f'Set audio device of application \'{application_name}\' to \'{audio_device}\'')
@@ -263,34 +458,103 @@ class ProcessWorker(QThread):
 
     # ------------------------------------------------------------------------------------------
 
-    def set_command_timer(self, event, delay_msec: int):
-        timer = QTimer()
-        self.delayedCommandTimers.append(timer)
-        timer.setSingleShot(True)
-        timer.timeout.connect(event)
-        timer.timeout.connect(lambda: self.delayedCommandTimers.remove(timer))
-        timer.start(delay_msec)
+    def in_startup_burst(self, now: float):
+        """checks if launch requests currently pile up, e.g. because many apps autostart on login
+
+        The burst lasts until the launches queued during it are worked off, even if that takes
+        longer than the detection window.
+        """
+        while self.recentRequests and now - self.recentRequests[0] > BURST_WINDOW_SEC:
+            self.recentRequests.popleft()
+        return len(self.recentRequests) >= BURST_REQUEST_THRESHOLD or any(l['Burst'] for l in self.pendingLaunches)
+
+    # ------------------------------------------------------------------------------------------
+
+    def reserved_launches(self, now: float):
+        """the pending commands the launch budget of the current slice is kept for
+
+        These are the ones with the highest priority that get due before the slice ends, so a low
+        priority app that gets due first doesn't use up the slice of a high priority one. Commands
+        overdue by more than BURST_MAX_WAIT_SLICES go first, oldest first, so they can't starve.
+        """
+        budget = max(BURST_LAUNCHES_PER_SLICE - self.sliceLaunches, 0)
+        slice_end = self.sliceStart + BURST_SLICE_SEC
+        max_wait = BURST_MAX_WAIT_SLICES * BURST_SLICE_SEC
+
+        def order(launch):
+            if now - launch['Deadline'] > max_wait:
+                return (0, 0, launch['Deadline'])
+            return (1, -launch['Priority'], launch['Deadline'])
+
+        candidates = sorted((l for l in self.pendingLaunches if l['Deadline'] <= slice_end), key=order)
+        return candidates[:budget]
+
+    # ------------------------------------------------------------------------------------------
+
+    def dispatch_launches(self):
+        """runs the due commands ordered by priority and deadline, capped per time slice during a burst"""
+        now = self.clock()
+        if self.in_startup_burst(now):
+            if now - self.sliceStart >= BURST_SLICE_SEC:
+                self.sliceStart = now
+                self.sliceLaunches = 0
+            due = [l for l in self.reserved_launches(now) if l['Deadline'] <= now]
+            self.sliceLaunches += len(due)
+        else:
+            due = sorted((l for l in self.pendingLaunches if l['Deadline'] <= now),
+                         key=lambda l: (-l['Priority'], l['Deadline']))
+
+        for launch in due:
+            self.pendingLaunches.remove(launch)
+            self.run_command(launch['Command'], launch['Application'], launch['AudioDevice'])
+
+        self.schedule_next_launch(self.clock())
+
+    # ------------------------------------------------------------------------------------------
+
+    def next_launch_time(self, now: float):
+        """returns when dispatch_launches has to run next, None if nothing is pending"""
+        if not self.pendingLaunches:
+            return None
+
+        next_launch = min(l['Deadline'] for l in self.pendingLaunches)
+        # outside of a burst or once the slice is over, the next due command starts a new slice
+        if not self.in_startup_burst(now) or now - self.sliceStart >= BURST_SLICE_SEC:
+            return next_launch
+        # wait for the commands the slice is reserved for, or for the next slice if it is used up
+        reserved = self.reserved_launches(now)
+        if reserved:
+            return min(l['Deadline'] for l in reserved)
+        return max(next_launch, self.sliceStart + BURST_SLICE_SEC)
+
+    # ------------------------------------------------------------------------------------------
+
+    def schedule_next_launch(self, now: float):
+        """starts the launch timer for the next pending command"""
+        next_launch = self.next_launch_time(now)
+        if next_launch is None:
+            self.launchTimer.stop()
+            return
+        self.launchTimer.start(max(math.ceil((next_launch - now) * 1000), 0))
 
     # ------------------------------------------------------------------------------------------
 
     def stop_all_command_timers(self):
-        for t in self.delayedCommandTimers:
-            t.stop()
-        self.delayedCommandTimers.clear()
+        self.launchTimer.stop()
+        self.pendingLaunches.clear()
 
     # ------------------------------------------------------------------------------------------
 
     def reset_process_states(self):
+        self.record(TRACE_RESET)
         # cancel all pending timers
         self.stop_all_command_timers()
 
-        pythoncom.CoInitialize()
-        c = wmi.WMI()
-
         # reset current state of all processes and set the device for any active ones again
         for p in self.process_dict:
             self.process_dict[p]['State'] = False
-            for process in c.Win32_Process(name=p):
+            for process in WmiConnectionPool.find_processes(p):
+                self.record(TRACE_PROCESS_FOUND, p, process.ProcessID)
                 self.process_started(p, process.ProcessID)
                 break;
 
@@ -307,6 +571,8 @@ class EnforceAudioDeviceApp(QApplication):
     sound_volume_view_path = 'SoundVolumeView.exe'
     # the thread the worker is running in
     thread: ProcessWorker = None
+    # records process events for offline replay if enabled in the config
+    trace: TraceRecorder = None
 
     # ------------------------------------------------------------------------------------------
 
@@ -348,13 +614,13 @@ class EnforceAudioDeviceApp(QApplication):
         self.stop_signal.connect(self.create_listener.stop)
         self.create_listener.finished.connect(self.create_listener.deleteLater)
         self.create_listener.watcher_signal.connect(
-            self.thread.process_started)
+            self.thread.on_process_created)
         self.create_listener.start()
 
         self.delete_listener = ProcessWatcher("deletion")
         self.stop_signal.connect(self.delete_listener.stop)
         self.delete_listener.finished.connect(self.delete_listener.deleteLater)
-        self.delete_listener.watcher_signal.connect(self.thread.process_ended)
+        self.delete_listener.watcher_signal.connect(self.thread.on_process_deleted)
         self.delete_listener.start()
 
     # ------------------------------------------------------------------------------------------
@@ -392,6 +658,8 @@ class EnforceAudioDeviceApp(QApplication):
 
     def finish_quit(self):
         logging.info('Exit')
+        WmiConnectionPool.release()
+        self.stop_trace()
         self.quit()
 
     # ------------------------------------------------------------------------------------------
@@ -451,10 +719,27 @@ class EnforceAudioDeviceApp(QApplication):
                              f'Invalid Sound Volume View path \'{self.sound_volume_view_path}\'.\nMake sure the path is set correctly in the Config.json.', ALERT_ICON_FILE_PATH)
             return False
 
+        # (re)start recording a trace if a trace file is configured
+        self.stop_trace()
+        if has_config and config['Config'].get('TraceFilePath'):
+            trace_path = app_path(config['Config']['TraceFilePath'])
+            try:
+                self.trace = TraceRecorder(trace_path)
+                logging.info(f'Recording trace to \'{trace_path}\'')
+            except OSError as e:
+                logging.warning(f'Failed to open trace file \'{trace_path}\': {e}')
+
         return True
 
     # ------------------------------------------------------------------------------------------
 
+    def stop_trace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    # ------------------------------------------------------------------------------------------
+
     def load_valid_audio_devices(self):
         """fills a dictionary of valid audio devices that can be used"""
         # if this file already exists, remove it
@@ -695,10 +980,9 @@ class EnforceAudioDeviceTrayIcon(QSystemTrayIcon):
 # ------------------------------------------------------------------------------------------
 
 def check_already_running():
-    c = wmi.WMI()
     process_name = os.path.basename(sys.argv[0])
     process_count = 0
-    for process in c.Win32_Process(name=process_name):
+    for process in WmiConnectionPool.find_processes(process_name):
         process_count = process_count + 1
         # two processes are from us, if there are more than 2, another instance is already running
         if process_count > 2:
@@ -709,6 +993,7 @@ def check_already_running():
 
 
 if __name__ == '__main__':
+    setup_logging()
     if not check_already_running():
         app = EnforceAudioDeviceApp(sys.argv)
         sys.exit(app.exec_())
@@ -0,0 +1,218 @@
+"""Fake stand-ins for the windows only backends used by EnforceAudioDevice.
+
+Installing them lets the app run on any platform: wmi and pythoncom are replaced by an in memory
+process table, plyer notifications are dropped and SoundVolumeView calls are answered without
+running anything. Used by the soak test and the trace replay tools.
+"""
+import sys
+import os
+import json
+import queue
+import threading
+import types
+import weakref
+
+# ------------------------------------------------------------------------------------------
+
+# audio devices reported by the fake SoundVolumeView
+FAKE_DEVICES = ['Game', 'Music', 'System', 'Voice']
+
+############################################################################################
+# FakeProcessTable
+############################################################################################
+
+
+class FakeProcess:
+    """mimics the fields of a Win32_Process wmi object that the app reads"""
+
+    def __init__(self, name: str, pid: int):
+        self.Name = name
+        self.Caption = name
+        self.ProcessID = pid
+
+
+class FakeProcessTable:
+    """in memory list of running processes that feeds creation and deletion events to fake watchers"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_pid = 1000
+        self.processes = {}
+        # watchers are held weakly so dropped watchers don't keep receiving events
+        self._watchers = {'creation': weakref.WeakSet(), 'deletion': weakref.WeakSet()}
+
+    # ------------------------------------------------------------------------------------------
+
+    def spawn(self, name: str, pid: int = None):
+        """adds a running process and returns its process id"""
+        with self._lock:
+            if pid is None:
+                self._next_pid += 4
+                pid = self._next_pid
+            process = FakeProcess(name, pid)
+            self.processes[pid] = process
+            watchers = list(self._watchers['creation'])
+        for w in watchers:
+            w.events.put(process)
+        return pid
+
+    # ------------------------------------------------------------------------------------------
+
+    def kill(self, pid: int):
+        """removes a running process, unknown ids are ignored"""
+        with self._lock:
+            process = self.processes.pop(pid, None)
+            watchers = list(self._watchers['deletion'])
+        if process is None:
+            return
+        for w in watchers:
+            w.events.put(process)
+
+    # ------------------------------------------------------------------------------------------
+
+    def find(self, name: str = None):
+        with self._lock:
+            return [p for p in self.processes.values() if name is None or p.Name.lower() == name.lower()]
+
+    # ------------------------------------------------------------------------------------------
+
+    def add_watcher(self, type: str, watcher):
+        with self._lock:
+            self._watchers[type].add(watcher)
+
+    # ------------------------------------------------------------------------------------------
+
+    def pending_events(self):
+        """number of events not yet picked up by any watcher"""
+        with self._lock:
+            watchers = [w for ws in self._watchers.values() for w in ws]
+        return sum(w.events.qsize() for w in watchers)
+
+############################################################################################
+# fake wmi
+############################################################################################
+
+
+class x_wmi(Exception):
+    pass
+
+
+class x_wmi_timed_out(x_wmi):
+    pass
+
+
+class com_error(Exception):
+    pass
+
+
+class FakeWatcher:
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def __call__(self, timeout_ms=-1):
+        try:
+            return self.events.get(timeout=None if timeout_ms < 0 else timeout_ms / 1000)
+        except queue.Empty:
+            raise x_wmi_timed_out()
+
+
+class FakeWin32Process:
+    def __init__(self, table: FakeProcessTable):
+        self.table = table
+
+    def __call__(self, name=None):
+        return self.table.find(name)
+
+    def watch_for(self, type: str):
+        watcher = FakeWatcher()
+        self.table.add_watcher(type, watcher)
+        return watcher
+
+
+class FakeWMI:
+    def __init__(self, table: FakeProcessTable):
+        self.Win32_Process = FakeWin32Process(table)
+
+############################################################################################
+# fake pythoncom
+############################################################################################
+
+
+class FakeCom:
+    """counts com initialization per thread so unbalanced CoInitialize calls show up"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.initialized = {}
+
+    def CoInitialize(self):
+        with self._lock:
+            ident = threading.get_ident()
+            self.initialized[ident] = self.initialized.get(ident, 0) + 1
+
+    def CoUninitialize(self):
+        with self._lock:
+            ident = threading.get_ident()
+            count = self.initialized.get(ident, 0) - 1
+            if count > 0:
+                self.initialized[ident] = count
+            else:
+                self.initialized.pop(ident, None)
+
+    def open_apartments(self):
+        with self._lock:
+            return sum(self.initialized.values())
+
+############################################################################################
+# fake SoundVolumeView
+############################################################################################
+
+
+class FakeSubprocess:
+    """answers SoundVolumeView commands in place of the subprocess module"""
+
+    def __init__(self, on_call=None):
+        self.calls = 0
+        # optional callback returning the exit code for a command
+        self.on_call = on_call
+
+    def call(self, command, shell=False):
+        self.calls += 1
+        # the app exports the valid audio devices with /sjson <file>
+        if ' /sjson ' in command:
+            path = command.split(' /sjson ', 1)[1].strip()
+            devices = [{'Name': d, 'Direction': 'Render', 'Type': 'Device'} for d in FAKE_DEVICES]
+            with open(path, 'w', encoding='UTF-16') as file:
+                json.dump(devices, file)
+            return 0
+        if self.on_call is not None:
+            return self.on_call(command)
+        return 0
+
+# ------------------------------------------------------------------------------------------
+
+
+def install(table: FakeProcessTable, com: FakeCom):
+    """registers the fake wmi, pythoncom and plyer modules, has to run before EnforceAudioDevice is imported"""
+    wmi_module = types.ModuleType('wmi')
+    wmi_module.WMI = lambda: FakeWMI(table)
+    wmi_module.x_wmi = x_wmi
+    wmi_module.x_wmi_timed_out = x_wmi_timed_out
+    sys.modules['wmi'] = wmi_module
+
+    pythoncom_module = types.ModuleType('pythoncom')
+    pythoncom_module.CoInitialize = com.CoInitialize
+    pythoncom_module.CoUninitialize = com.CoUninitialize
+    pythoncom_module.com_error = com_error
+    sys.modules['pythoncom'] = pythoncom_module
+
+    plyer_module = types.ModuleType('plyer')
+    plyer_module.notification = types.SimpleNamespace(notify=lambda **kwargs: None)
+    sys.modules['plyer'] = plyer_module
+
+    # there is no tray or display to show anything on
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    # make the app importable from the tools folder
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if root not in sys.path:
+        sys.path.insert(0, root)
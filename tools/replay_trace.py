@@ -0,0 +1,311 @@
+"""Replays a trace recorded by EnforceAudioDevice through the ProcessWorker using fake backends.
+
+Traces are recorded by the app when 'TraceFilePath' is set in the 'Config' section of the config.
+The replay feeds the recorded apps, process events and resets back into a ProcessWorker at real
+time or accelerated speed, answers helper launches with the recorded exit codes and compares the
+resulting scheduling decisions and helper outcomes with the recorded ones. With speed 0 the worker
+runs on a virtual clock that jumps from entry to entry, which replays as fast as possible and
+deterministically. Runs on any platform with PyQt5 installed, e.g. to profile a trace:
+
+    python -m cProfile -s cumtime tools/replay_trace.py EnforceAudioDevice.trace --speed 0
+"""
+import sys
+import json
+import math
+import time
+import types
+import logging
+import argparse
+from collections import defaultdict, deque
+
+import fake_backends
+
+# fake backends have to be in place before the app module is imported
+PROCESS_TABLE = fake_backends.FakeProcessTable()
+COM = fake_backends.FakeCom()
+fake_backends.install(PROCESS_TABLE, COM)
+
+import EnforceAudioDevice as ead
+from PyQt5.QtCore import QCoreApplication, QEventLoop
+
+# entries that are the outcome of the worker and are compared instead of replayed
+OUTCOME_KINDS = (ead.TRACE_SCHEDULED, ead.TRACE_RESULT)
+
+# ------------------------------------------------------------------------------------------
+
+
+def read_trace(path: str):
+    """returns a list of (seconds since the first recording started, entry) for every entry of the trace"""
+    entries = []
+    first_start = None
+    start = None
+    last = 0.0
+    with open(path, 'r', encoding='UTF-8') as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line might be cut off if the app was killed while writing
+                logging.warning(f'Skipping broken line {number} of \'{path}\'')
+                continue
+            # a header starts a new recording, e.g. after a config reload
+            if isinstance(entry, dict):
+                if entry.get('v') != ead.TraceRecorder.VERSION:
+                    raise ValueError(f'Unsupported trace version {entry.get("v")} in line {number} of \'{path}\'')
+                start = entry['start']
+                if first_start is None:
+                    first_start = start
+                continue
+            if start is None:
+                raise ValueError(f'Trace entry without header in line {number} of \'{path}\'')
+            # keep the time going forward even if the wall clock was changed between recordings
+            last = max(last, start - first_start + entry[0] / 1000)
+            entries.append((last, entry))
+    return entries
+
+############################################################################################
+# ReplayRecorder
+############################################################################################
+
+
+class ReplayRecorder:
+    """collects the outcomes of the replayed worker and optionally writes them to a new trace"""
+
+    def __init__(self, path: str = None, clock=None):
+        self.outcomes = []
+        self.trace = ead.TraceRecorder(path) if path else None
+        # virtual clock of the replay in seconds, without one the trace uses the real time
+        self.clock = clock
+
+    def record(self, kind: str, *data):
+        if kind in OUTCOME_KINDS:
+            self.outcomes.append(outcome_key(kind, data))
+        if self.trace is None:
+            return
+        if self.clock is None:
+            self.trace.record(kind, *data)
+        else:
+            self.trace.write([int(self.clock() * 1000), kind, *data])
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+
+# ------------------------------------------------------------------------------------------
+
+
+def outcome_key(kind: str, data):
+    """the part of an outcome entry that has to match, delays are left out as they get scaled"""
+    if kind == ead.TRACE_SCHEDULED:
+        return (kind, data[0], data[1])
+    return (kind, data[0], data[1], data[2])
+
+############################################################################################
+# TraceReplay
+############################################################################################
+
+
+class TraceReplay:
+    """feeds trace entries into a ProcessWorker backed by the fake process table"""
+
+    def __init__(self, entries, speed: float, output: str = None):
+        self.entries = entries
+        self.speed = speed
+        self.recorded = []
+        # exit codes of the helper per app in the recorded order
+        self.results = defaultdict(deque)
+        for _, entry in entries:
+            if entry[1] == ead.TRACE_RESULT:
+                self.results[entry[2]].append(entry[4])
+
+        # time of the virtual clock used with speed 0
+        self.now = 0.0
+        if speed > 0:
+            # the burst throttling runs on the same accelerated clock as the trace
+            ead.BURST_WINDOW_SEC = ead.BURST_WINDOW_SEC / speed
+            ead.BURST_SLICE_SEC = ead.BURST_SLICE_SEC / speed
+
+        self.qt_app = QCoreApplication.instance() or QCoreApplication(sys.argv[:1])
+        self.recorder = ReplayRecorder(output, self.virtual_clock if speed <= 0 else None)
+        self.subprocess = fake_backends.FakeSubprocess(on_call=self.helper_result)
+        ead.subprocess = self.subprocess
+        # stands in for the EnforceAudioDeviceApp the worker reads its config from
+        self.app = types.SimpleNamespace(valid_devices=set(), sound_volume_view_path='SoundVolumeView.exe',
+                                         trace=self.recorder)
+        self.worker = ead.ProcessWorker(app=self.app)
+        if speed <= 0:
+            self.worker.clock = self.virtual_clock
+
+    # ------------------------------------------------------------------------------------------
+
+    def virtual_clock(self):
+        return self.now
+
+    # ------------------------------------------------------------------------------------------
+
+    def helper_result(self, command: str):
+        """answers a helper launch with the next recorded exit code of the app"""
+        application = command.rsplit('"', 2)[-2]
+        codes = self.results[application]
+        return codes.popleft() if codes else 0
+
+    # ------------------------------------------------------------------------------------------
+
+    def dispatch(self, entry):
+        kind, data = entry[1], entry[2:]
+        if kind == ead.TRACE_APP:
+            application, device, delay = data[:3]
+            self.app.valid_devices.add(device)
+            # the priority was added to the entry later on, older traces don't have it
+            priority = data[3] if len(data) > 3 else 0
+            # scale the helper delay along with the replay speed, the virtual clock uses it as is
+            if self.speed > 0:
+                delay = delay / self.speed
+            self.worker.add_app(application, {'Device': device, 'Delay': delay, 'Priority': priority})
+        elif kind == ead.TRACE_PROCESS_CREATED:
+            name, id = data
+            PROCESS_TABLE.spawn(name, id)
+            self.worker.on_process_created(name, id)
+        elif kind == ead.TRACE_PROCESS_DELETED:
+            name, id = data
+            PROCESS_TABLE.kill(id)
+            self.worker.on_process_deleted(name, id)
+        elif kind == ead.TRACE_PROCESS_FOUND:
+            # usually already spawned by spawn_found_processes
+            name, id = data
+            if id not in PROCESS_TABLE.processes:
+                PROCESS_TABLE.spawn(name, id)
+        elif kind == ead.TRACE_RESET:
+            self.worker.reset_process_states()
+        elif kind in OUTCOME_KINDS:
+            self.recorded.append(outcome_key(kind, data))
+        else:
+            logging.warning(f'Unknown trace entry kind \'{kind}\'')
+
+    # ------------------------------------------------------------------------------------------
+
+    def spawn_found_processes(self, index: int):
+        """spawns the processes the app found right after an app or reset entry, so the query finds them"""
+        for i in range(index + 1, len(self.entries)):
+            entry = self.entries[i][1]
+            if entry[1] == ead.TRACE_PROCESS_FOUND:
+                self.dispatch(entry)
+            elif entry[1] != ead.TRACE_SCHEDULED:
+                return
+
+    # ------------------------------------------------------------------------------------------
+
+    def advance(self, target: float):
+        """moves the virtual clock to the target and runs every launch that gets due on the way"""
+        last_dispatch = None
+        while True:
+            next_launch = self.worker.next_launch_time(self.now)
+            if next_launch is None or next_launch > target:
+                break
+            self.now = max(self.now, next_launch)
+            pending = len(self.worker.pendingLaunches)
+            if last_dispatch == (self.now, pending):
+                logging.error(f'Worker keeps waking up at {self.now:.3f}s without launching anything')
+                break
+            last_dispatch = (self.now, pending)
+            self.worker.dispatch_launches()
+        if target != math.inf:
+            self.now = max(self.now, target)
+
+    # ------------------------------------------------------------------------------------------
+
+    def wait_until(self, target: float):
+        """processes events until the monotonic clock reaches the target"""
+        while True:
+            remaining = target - time.monotonic()
+            if remaining <= 0:
+                return
+            self.qt_app.processEvents(QEventLoop.AllEvents, 10)
+            time.sleep(min(remaining, 0.005))
+
+    # ------------------------------------------------------------------------------------------
+
+    def pump(self, timeout: float = 120.0):
+        """processes events until no helper launch is pending anymore"""
+        deadline = time.monotonic() + timeout
+        while True:
+            self.qt_app.processEvents(QEventLoop.AllEvents, 10)
+            if not self.worker.pendingLaunches or time.monotonic() > deadline:
+                return
+            time.sleep(0.001)
+
+    # ------------------------------------------------------------------------------------------
+
+    def run(self):
+        begin = time.monotonic()
+        for index, (at, entry) in enumerate(self.entries):
+            if self.speed > 0:
+                self.wait_until(begin + at / self.speed)
+            else:
+                self.advance(at)
+            if entry[1] in (ead.TRACE_APP, ead.TRACE_RESET):
+                self.spawn_found_processes(index)
+            self.dispatch(entry)
+        if self.speed > 0:
+            self.pump()
+        else:
+            self.advance(math.inf)
+        self.worker.stop_all_command_timers()
+        ead.WmiConnectionPool.release()
+        self.recorder.close()
+        return time.monotonic() - begin
+
+    # ------------------------------------------------------------------------------------------
+
+    def report(self, path: str, duration: float):
+        """prints a summary and returns if the replayed outcomes match the recorded ones"""
+        replayed = self.recorder.outcomes
+        span = self.entries[-1][0] if self.entries else 0.0
+        process_events = sum(1 for _, e in self.entries if e[1] in (ead.TRACE_PROCESS_CREATED, ead.TRACE_PROCESS_DELETED))
+        print(f'Replayed {len(self.entries)} entries ({process_events} process events) of \'{path}\' '
+              f'in {duration:.2f}s, trace spans {span:.2f}s')
+        for kind, label in ((ead.TRACE_SCHEDULED, 'Scheduled launches'), (ead.TRACE_RESULT, 'Helper results')):
+            recorded = sum(1 for o in self.recorded if o[0] == kind)
+            print(f'  {label:<20}recorded {recorded:>8}   replayed {sum(1 for o in replayed if o[0] == kind):>8}')
+        print(f'  {"Helper calls":<20}{self.subprocess.calls:>17}')
+
+        for i, (recorded, ours) in enumerate(zip(self.recorded, replayed)):
+            if recorded != ours:
+                print(f'First divergence at outcome #{i}: recorded {recorded}, replayed {ours}')
+                return False
+        if len(self.recorded) != len(replayed):
+            print(f'Outcomes match up to #{min(len(self.recorded), len(replayed))}, then one side ends')
+            return False
+        print('Replayed outcomes match the recorded trace')
+        return True
+
+# ------------------------------------------------------------------------------------------
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('trace', help='trace file recorded by the app')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed, 1 is real time, 0 replays as fast as possible')
+    parser.add_argument('--output', help='write the trace of the replay to this file')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the app while replaying')
+    return parser.parse_args(argv)
+
+# ------------------------------------------------------------------------------------------
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    # the app only sets up its log file when run directly, log to stdout instead
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    replay = TraceReplay(read_trace(args.trace), args.speed, args.output)
+    duration = replay.run()
+    return 0 if replay.report(args.trace, duration) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""Long running soak test for EnforceAudioDevice using fake backends.
+
+Drives days worth of simulated process churn through the real app (watcher threads, worker,
+reloads and resets) and reports memory, object, timer and thread counts over time so leaks show
+up as growth between reports. Runs on any platform with PyQt5 installed, e.g.:
+
+    python tools/soak_test.py --days 7 --events-per-hour 600 --csv soak.csv
+"""
+import sys
+import os
+import gc
+import csv
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+import fake_backends
+
+# fake backends have to be in place before the app module is imported
+PROCESS_TABLE = fake_backends.FakeProcessTable()
+COM = fake_backends.FakeCom()
+fake_backends.install(PROCESS_TABLE, COM)
+
+import EnforceAudioDevice as ead
+from PyQt5.QtCore import QCoreApplication, QEvent, QEventLoop, QThread, QTimer
+
+# counters that have to stay flat while the app is running
+HANDLE_COLUMNS = ['qthreads', 'qtimers', 'wmi_connections', 'com_apartments']
+COLUMNS = ['hour', 'events', 'rss_kb', 'objects', 'os_threads', 'pending_timers'] + HANDLE_COLUMNS + ['helper_calls']
+
+# ------------------------------------------------------------------------------------------
+
+
+def rss_kb():
+    """resident memory of this process in kB, 0 if it can't be determined"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss // 1024
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+# ------------------------------------------------------------------------------------------
+
+
+def os_thread_count():
+    """number of os threads of this process, 0 if it can't be determined"""
+    try:
+        import psutil
+        return psutil.Process().num_threads()
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+############################################################################################
+# SoakTest
+############################################################################################
+
+
+class SoakTest:
+    """runs the app against a simulated process table and samples resource usage"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.events = 0
+        self.samples = []
+        self.subprocess = fake_backends.FakeSubprocess()
+        self.apps = [f'soakapp{i}.exe' for i in range(args.apps)]
+        self.noise = [f'noise{i}.exe' for i in range(args.noise)]
+
+    # ------------------------------------------------------------------------------------------
+
+    def setup(self, directory):
+        """points the app at a generated config and fake SoundVolumeView, then starts it"""
+        sound_volume_view_path = os.path.join(directory, 'SoundVolumeView.exe')
+        open(sound_volume_view_path, 'w').close()
+        apps = {}
+        for i, app in enumerate(self.apps):
+            # mostly immediate launches, some delayed ones so resets have pending timers to cancel
+            delay = '0.05' if i % 4 == 0 else '0'
+            apps[app] = {'Device': fake_backends.FAKE_DEVICES[i % len(fake_backends.FAKE_DEVICES)], 'Delay': delay}
+        config = {'Config': {'SoundVolumeViewPath': sound_volume_view_path}, 'Apps': apps}
+        with open(os.path.join(directory, 'EnforceAudioDevice.json'), 'w', encoding='UTF-8') as file:
+            json.dump(config, file, indent=2)
+
+        ead.CONFIG_FILE_PATH = os.path.join(directory, 'EnforceAudioDevice.json')
+        ead.VALID_DEVICES_FILE_PATH = os.path.join(directory, 'ValidDevices.json')
+        ead.subprocess = self.subprocess
+        # the simulated churn is a permanent burst, keep the throttled launches flowing
+        ead.BURST_SLICE_SEC = 0.005
+        self.app = ead.EnforceAudioDeviceApp(sys.argv[:1])
+        self.pump()
+
+    # ------------------------------------------------------------------------------------------
+
+    def pump(self, timeout: float = 10.0):
+        """processes events until all process events are delivered and no helper launch is pending"""
+        deadline = time.monotonic() + timeout
+        idle = 0
+        while time.monotonic() < deadline and idle < 3:
+            self.app.processEvents(QEventLoop.AllEvents, 20)
+            # deleteLater is only handled by a running event loop, flush it manually. This is only safe
+            # because reload and quit wait for stopped threads, deleting a running QThread aborts
+            QCoreApplication.sendPostedEvents(None, QEvent.DeferredDelete)
+            if PROCESS_TABLE.pending_events() == 0 and self.pending_timers() == 0:
+                idle += 1
+            else:
+                idle = 0
+            time.sleep(0.002)
+
+    # ------------------------------------------------------------------------------------------
+
+    def pending_timers(self):
+        try:
+            return len(self.app.thread.pendingLaunches)
+        except (AttributeError, RuntimeError):
+            # the worker was already deleted
+            return 0
+
+    # ------------------------------------------------------------------------------------------
+
+    def step(self):
+        """starts or ends a single simulated process"""
+        self.events += 1
+        if len(PROCESS_TABLE.processes) >= self.args.max_processes:
+            PROCESS_TABLE.kill(self.rng.choice(list(PROCESS_TABLE.processes)))
+            return
+        name = self.rng.choice(self.apps + self.noise)
+        running = PROCESS_TABLE.find(name)
+        if running and self.rng.random() < 0.5:
+            PROCESS_TABLE.kill(self.rng.choice(running).ProcessID)
+        else:
+            PROCESS_TABLE.spawn(name)
+
+    # ------------------------------------------------------------------------------------------
+
+    def app_threads(self):
+        """the worker and listener threads the app is currently running"""
+        return [self.app.thread, self.app.create_listener, self.app.delete_listener]
+
+    # ------------------------------------------------------------------------------------------
+
+    def wait_for_threads(self, threads):
+        """waits until the stopped threads returned from run, so they can be deleted safely"""
+        for thread in threads:
+            try:
+                if not thread.wait(ead.WATCHER_TIMEOUT_MSEC * 4):
+                    logging.error(f'{type(thread).__name__} did not stop in time')
+            except RuntimeError:
+                # wrapper of an already deleted thread
+                pass
+
+    # ------------------------------------------------------------------------------------------
+
+    def reload(self):
+        """reloads the config the same way the tray menu does and waits for the new threads to settle"""
+        old_threads = self.app_threads()
+        connections = ead.WmiConnectionPool.open_connections
+        self.app.start_reload_config()
+        self.wait_for_threads(old_threads)
+        # wait for the new worker and for the new listeners to connect in place of the old ones
+        deadline = time.monotonic() + 10.0
+        while time.monotonic() < deadline and (self.app.thread is old_threads[0]
+                                               or ead.WmiConnectionPool.open_connections != connections):
+            self.pump(0.1)
+        if self.app.thread is old_threads[0]:
+            logging.error('Reload did not finish in time')
+        elif ead.WmiConnectionPool.open_connections != connections:
+            logging.error(f'WMI connections did not settle after reload: {connections} -> '
+                          f'{ead.WmiConnectionPool.open_connections}')
+
+    # ------------------------------------------------------------------------------------------
+
+    def quit(self):
+        old_threads = self.app_threads()
+        self.app.start_quit()
+        # the watcher threads release their connections before they return from run
+        self.wait_for_threads(old_threads)
+        # the main thread connection is released once the worker got deleted
+        deadline = time.monotonic() + 10.0
+        while ead.WmiConnectionPool.open_connections > 0 and time.monotonic() < deadline:
+            self.pump(0.1)
+
+    # ------------------------------------------------------------------------------------------
+
+    def sample(self, hour):
+        gc.collect()
+        objects = gc.get_objects()
+        row = {
+            'hour': hour,
+            'events': self.events,
+            'rss_kb': rss_kb(),
+            'objects': len(objects),
+            'os_threads': os_thread_count(),
+            'pending_timers': self.pending_timers(),
+            'qthreads': sum(1 for o in objects if isinstance(o, QThread) and self.is_running(o)),
+            'qtimers': sum(1 for o in objects if isinstance(o, QTimer)),
+            'wmi_connections': ead.WmiConnectionPool.open_connections,
+            'com_apartments': COM.open_apartments(),
+            'helper_calls': self.subprocess.calls,
+        }
+        del objects
+        self.samples.append(row)
+        print(' '.join(f'{row[c]:>{len(c)}}' for c in COLUMNS), flush=True)
+        return row
+
+    # ------------------------------------------------------------------------------------------
+
+    @staticmethod
+    def is_running(thread):
+        try:
+            return thread.isRunning()
+        except RuntimeError:
+            # wrapper of an already deleted thread
+            return False
+
+    # ------------------------------------------------------------------------------------------
+
+    def run(self):
+        args = self.args
+        print(' '.join(COLUMNS), flush=True)
+        self.sample(0)
+        for hour in range(1, int(args.days * 24) + 1):
+            for _ in range(args.events_per_hour):
+                self.step()
+                if self.events % args.batch == 0:
+                    self.pump()
+            self.pump()
+            if args.reset_every and hour % args.reset_every == 0:
+                self.app.reset_processes()
+                self.pump()
+            if args.reload_every and hour % args.reload_every == 0:
+                self.reload()
+            if hour % args.report_every == 0:
+                self.sample(hour)
+        self.quit()
+        return self.sample(int(args.days * 24))
+
+    # ------------------------------------------------------------------------------------------
+
+    def report_growth(self, final):
+        """compares the first sample after warm up with the last sample while running"""
+        running = self.samples[:-1]
+        if len(running) < 3:
+            print('Not enough samples to judge growth, run longer or report more often')
+            return True
+        baseline, last = running[1], running[-1]
+        ok = True
+        print(f'\nGrowth between hour {baseline["hour"]} and hour {last["hour"]}:')
+        for column in ['rss_kb', 'objects', 'os_threads'] + HANDLE_COLUMNS:
+            delta = last[column] - baseline[column]
+            flag = ''
+            if column in HANDLE_COLUMNS and delta > 0:
+                flag = '  <-- leak'
+                ok = False
+            print(f'  {column:<16}{baseline[column]:>10} -> {last[column]:>10} ({delta:+}){flag}')
+        # after quitting every thread, connection and apartment has to be released
+        for column in ['qthreads', 'wmi_connections', 'com_apartments']:
+            if final[column] != 0:
+                print(f'  {column} still open after quit: {final[column]}  <-- leak')
+                ok = False
+        return ok
+
+# ------------------------------------------------------------------------------------------
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--days', type=float, default=7, help='simulated days to run')
+    parser.add_argument('--events-per-hour', type=int, default=600, help='process start/end events per simulated hour')
+    parser.add_argument('--apps', type=int, default=20, help='number of configured apps')
+    parser.add_argument('--noise', type=int, default=40, help='number of unconfigured processes that churn as well')
+    parser.add_argument('--max-processes', type=int, default=80, help='upper bound of simulated running processes')
+    parser.add_argument('--batch', type=int, default=50, help='events generated before the app gets to process them')
+    parser.add_argument('--reset-every', type=int, default=6, help='simulated hours between "Reset audio devices", 0 to disable')
+    parser.add_argument('--reload-every', type=int, default=24, help='simulated hours between config reloads, 0 to disable')
+    parser.add_argument('--report-every', type=int, default=12, help='simulated hours between reports')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help='also write all samples to this csv file')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the app while soaking')
+    return parser.parse_args(argv)
+
+# ------------------------------------------------------------------------------------------
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    # the app only sets up its log file when run directly, log to stdout instead
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s [%(levelname)s] %(message)s")
+
+    soak = SoakTest(args)
+    with tempfile.TemporaryDirectory() as directory:
+        soak.setup(directory)
+        final = soak.run()
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(soak.samples)
+
+    return 0 if soak.report_growth(final) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())